@@ -1,14 +1,24 @@
-from datetime import datetime
+from bisect import bisect_right
 import json
+import math
+import os
+import threading
+import time
 import appdaemon.plugins.hass.hassapi as hass
 
+# apps sharing a state_file run in separate threads
+_STATE_FILE_LOCK = threading.Lock()
+
 #WindAlarm:
 #  module: i1_weather_wind_alarm
 #  class: WeatherWindAlarm
 #  sensor: "weather.smhi_home"
 #  recipients:
 #    - mobile_app_louies_telefon
+#  notify_group: "family" # optional, single notify/family call instead of one per recipient
 #  name: "Vind"
+#  verbose: false # optional, log every check (default false)
+#  state_file: "/config/appdaemon/wind_alarm.json" # optional, keep cooldowns across restarts, can be shared between apps
 #  limits:
 #    - lt: 20
 #      gt: 10
@@ -28,13 +38,19 @@ import appdaemon.plugins.hass.hassapi as hass
 #      msg_cooldown: 3600
 
 class WeatherWindAlarm(hass.Hass):
+  # sensor attribute holding the value to check
+  ATTRIBUTE = "wind_speed"
+
   def initialize(self):
     self.log("Loading WindAlarm()")
 
     self.sensor = self.args.get("sensor")
     self.recipients = self.args.get("recipients")
+    self.notify_group = self.args.get("notify_group")
     self.alert_name = self.args.get("name")
     self.limits = self.args.get("limits")
+    self.verbose = bool(self.args.get("verbose", False))
+    self.state_file = self.args.get("state_file")
 
     if self.sensor is None:
       self.log(" >> WindAlarm.initialize(): Warning - Not configured")
@@ -43,19 +59,54 @@ class WeatherWindAlarm(hass.Hass):
     if not isinstance(self.recipients, list):
       self.recipients = [self.recipients]
 
-    self.listen_state(self.state_change, self.sensor, attribute="wind_speed")
-    
-    self.log(" >> WindAlarm {} ==> {}".format(self.sensor,
-                                                 self.recipients))
+    if not isinstance(self.limits, list):
+      self.log(" >> WindAlarm.initialize(): Warning - No limits configured")
+      return
+    for limit in self.limits:
+      if not isinstance(limit, dict) or not all(
+          isinstance(limit.get(key), (int, float)) and not isinstance(limit.get(key), bool)
+          for key in ("gt", "lt", "msg_cooldown")):
+        self.log(" >> WindAlarm.initialize(): Warning - Limit needs numeric gt, lt and msg_cooldown {}".format(limit))
+        return
 
-    # add some more stuff to the limits dict
+    # sort the limits on their lower bound so check_state() can bisect,
+    # which only works if the ranges are non-empty and don't overlap
+    self.limits.sort(key=lambda limit: limit.get("gt"))
     for limit in self.limits:
-        limit["lmts"] = datetime(1970, 1, 1) # last message timestamp
+      if limit.get("gt") >= limit.get("lt"):
+        self.log(" >> WindAlarm.initialize(): Warning - Empty limit {}".format(limit))
+        return
+    for lower, upper in zip(self.limits, self.limits[1:]):
+      if upper.get("gt") < lower.get("lt"):
+        self.log(" >> WindAlarm.initialize(): Warning - Overlapping limits {} and {}".format(lower, upper))
+        return
+
+    # split the sorted limits into parallel lists indexed by limit position
+    self.limit_gts = [limit.get("gt") for limit in self.limits]
+    self.limit_lts = [limit.get("lt") for limit in self.limits]
+    self.limit_cooldowns = [float(limit.get("msg_cooldown")) for limit in self.limits]
+    self.limit_messages = [limit.get("message") for limit in self.limits]
+    self.limit_keys = ["{}-{}".format(gt, lt) for gt, lt in zip(self.limit_gts, self.limit_lts)] # state_file keys
+    self.limit_lmts = [float("-inf")] * len(self.limits) # last message timestamp (monotonic)
+    self.load_cooldowns()
+
+    # notification services, title and per limit message templates never change
+    self.services = ["notify/{}".format(recipient) for recipient in self.recipients]
+    if self.notify_group is not None:
+      self.services = ["notify/{}".format(self.notify_group)]
+    self.title = "{} temp".format(self.alert_name)
+    self.limit_templates = [str(message).replace("{", "{{").replace("}", "}}") + " ({}°)"
+                            for message in self.limit_messages]
 
-    self.check_state(self.get_state(self.sensor, "wind_speed"))
+    self.log(" >> WindAlarm {} ==> {}".format(self.sensor,
+                                                 self.services))
+
+    # only listen once everything check_state() uses is in place
+    self.listen_state(self.state_change, self.sensor, attribute=self.ATTRIBUTE)
+    self.check_state(self.get_state(self.sensor, self.ATTRIBUTE))
 
   def state_change(self, entity, attribute, old, new, kwargs):
-    if attribute != "wind_speed":
+    if attribute != self.ATTRIBUTE:
         return
     if new != old and new is not None:
       self.check_state(new)
@@ -65,28 +116,97 @@ class WeatherWindAlarm(hass.Hass):
     if new is None:
         return
 
-    self.log("check_state({})".format(new))
-    value = float(new)
+    # parse and validate in one place, for both the startup value and
+    # state changes
+    try:
+        value = float(new)
+    except (ValueError, TypeError):
+        return
+    if not math.isfinite(value): # "nan" and "inf" parse but match no band
+        return
 
-    now = datetime.now()
-    message = None
-    for limit in self.limits:
-        self.log("lim: {}".format(limit))
-        if value < limit.get("lt") and value >= limit.get("gt"):
-            if (now - limit.get("lmts")).total_seconds() > limit.get("msg_cooldown"):
-                self.log("SEND: {}".format(limit.get("message")))
-                message = "{} ({}°)".format(limit.get("message"), value)
-                limit["lmts"] = datetime.now()
-            else:
-                self.log("Cooldown active {} {}".format((now - limit.get("lmts")).total_seconds(), limit.get("msg_cooldown")))
+    now = time.monotonic()
+    idx = bisect_right(self.limit_gts, value) - 1
+    if idx >= 0 and not value < self.limit_lts[idx]:
+        idx = -1
 
-            break
+    if self.verbose:
+        self.log("check_state({})".format(new))
+
+    message = None
+    if idx >= 0:
+        if self.verbose:
+            self.log("lim: {}".format(self.limits[idx]))
+        elapsed = now - self.limit_lmts[idx]
+        if elapsed > self.limit_cooldowns[idx]:
+            self.log("SEND: {}".format(self.limit_messages[idx]))
+            message = self.limit_templates[idx].format(value)
+            self.limit_lmts[idx] = now
+            self.save_cooldowns()
+        elif self.verbose:
+            self.log("Cooldown active {} {}".format(elapsed, self.limit_cooldowns[idx]))
 
     if message is None:
-        self.log("No message, returning")
+        if self.verbose:
+            self.log("No message, returning")
+        return
+
+    self.log("sending '{}' to {}".format(message, ", ".join(self.services)))
+    for service in self.services:
+        self.call_service(service, title=self.title, message=message)
+
+  def read_state_file(self):
+    # the whole state file: app name -> "gt-lt" band -> wall clock time of last send
+    try:
+        with open(self.state_file) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {} # first start, nothing sent yet
+    except (OSError, ValueError) as e:
+        self.log(" >> WindAlarm.read_state_file(): Warning - Ignoring {}: {}".format(self.state_file, e))
+        return {}
+    if not isinstance(state, dict):
+        self.log(" >> WindAlarm.read_state_file(): Warning - Ignoring {}: not a JSON object".format(self.state_file))
+        return {}
+    return state
+
+  def load_cooldowns(self):
+    if self.state_file is None:
+        return
+
+    with _STATE_FILE_LOCK:
+        sent = self.read_state_file().get(self.name, {})
+    if not isinstance(sent, dict):
+        self.log(" >> WindAlarm.load_cooldowns(): Warning - Ignoring {} entry in {}: not a JSON object".format(self.name, self.state_file))
+        return
+
+    # monotonic time doesn't survive a restart, so go via the wall clock
+    offset = time.monotonic() - time.time()
+    try:
+        for idx, key in enumerate(self.limit_keys):
+            if key in sent:
+                self.limit_lmts[idx] = float(sent[key]) + offset
+    except (ValueError, TypeError) as e:
+        self.log(" >> WindAlarm.load_cooldowns(): Warning - Ignoring {} entry in {}: {}".format(self.name, self.state_file, e))
+
+  def save_cooldowns(self):
+    if self.state_file is None:
         return
 
-    for recipient in self.recipients:
-        self.log("sending '{}' to {}".format(message, recipient))
-        self.call_service("notify/{}".format(recipient), title="{} temp".format(self.alert_name), message=message)
-    
+    offset = time.time() - time.monotonic()
+    sent = {key: lmts + offset
+            for key, lmts in zip(self.limit_keys, self.limit_lmts)
+            if lmts != float("-inf")}
+    # the file may be shared between apps, so only replace this app's
+    # entry; write a temp file and swap it in, so a crash mid-write can't
+    # leave a truncated state file behind
+    tmp_file = self.state_file + ".tmp"
+    with _STATE_FILE_LOCK:
+        state = self.read_state_file()
+        state[self.name] = sent
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            self.log(" >> WindAlarm.save_cooldowns(): Warning - Could not write {}: {}".format(self.state_file, e))